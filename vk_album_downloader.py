@@ -5,29 +5,35 @@ Async downloader for a single VK photo album.
 Highlights
 ----------
 • Handles both desktop and mobile URLs
-• Fully async (httpx + aiofiles)
+• Fully async (httpx; file I/O off the event loop)
 • Resume-safe (checkpoint file with already-scraped URLs)
 • Structured logging (console + rotating file handler)
 • Graceful retries with exponential back-off
 • Concurrency limiter
+• Uses uvloop when installed
 """
 from __future__ import annotations
 
 import argparse
 import asyncio
+import hashlib
 import logging
 import logging.handlers
 import random
 import re
 import sys
+import time
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Final, Iterable
+from typing import Awaitable, Callable, Final, Iterable, TypeVar
 
-import aiofiles
 import httpx
 import orjson
-from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+try:  # optional, faster event loop (not available on Windows)
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # ──────────────────────────────── CONFIG ──────────────────────────────── #
 
@@ -55,6 +61,10 @@ class Settings:
     min_delay: float = 0
     max_delay: float = 1
     concurrent_downloads: int = 8
+    min_bytes: int = 0               # skip images whose Content-Length is below this
+    max_bytes: int = 0               # ...or above this (0 = no limit)
+    breaker_threshold: int = 10      # consecutive 429/5xx/transport errors before pausing
+    breaker_cooldown: float = 30.0   # seconds all downloads wait once the breaker trips
     url_suffix_to_remove: str = '&from=bu&cs=240x0'
     headers_api: dict[str, str] = field(default_factory=get_default_api_headers)
     headers_download: dict[str, str] = field(default_factory=get_default_download_headers)
@@ -62,10 +72,19 @@ class Settings:
 
 SETTINGS: Final = Settings()
 
+DOWNLOAD_CHUNK_SIZE: Final = 64 * 1024
+DOWNLOAD_FLUSH_SIZE: Final = 1024 * 1024
+DOWNLOAD_QUEUE_SIZE: Final = 256
+
+# (index, url) items; ``None`` tells a worker to stop
+DownloadQueue = asyncio.Queue[tuple[int, str] | None]
+
 
 # ──────────────────────────────── UTILS ───────────────────────────────── #
 
 ALBUM_ID_RE = re.compile(r'album(-?\d+_\d+)')
+COMMENT_PREFIX: Final = b'<!--'
+COMMENT_SUFFIX: Final = b'-->'
 
 def parse_album_id(url: str) -> str | None:
     """Return the VK album id portion: album-123_456 → -123_456."""
@@ -73,6 +92,60 @@ def parse_album_id(url: str) -> str | None:
     return m.group(1) if m else None
 
 
+def extract_urls(blob: str) -> list[str]:
+    """Return the contents of every ``url(...)`` in *blob* (plain find/slice, no regex)."""
+    out: list[str] = []
+    pos = 0
+    while (i := blob.find('url(', pos)) >= 0:
+        j = blob.find(')', i + 4)
+        if j < 0:
+            break
+        out.append(blob[i + 4:j])
+        pos = j + 1
+    return out
+
+
+def _is_overload(exc: BaseException) -> bool:
+    """True for errors that suggest the server is throttling or unwell (429, 5xx, transport)."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def _sync_append(path: Path, data: bytes) -> None:
+    """Blocking append; meant to be run via ``asyncio.to_thread``."""
+    with path.open('ab') as f:
+        f.write(data)
+
+
+def _sync_replace(path: Path, data: bytes) -> None:
+    """Blocking atomic overwrite (temp file + rename); run via ``asyncio.to_thread``."""
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+T = TypeVar('T')
+
+
+async def retry_async(
+    fn: Callable[[], Awaitable[T]],
+    *,
+    attempts: int = 3,
+    max_wait: float = 20.0,
+    retry_on: tuple[type[BaseException], ...] = (httpx.HTTPError, asyncio.TimeoutError),
+) -> T:
+    """Call *fn* up to *attempts* times with full-jitter exponential back-off."""
+    for n in range(attempts):
+        try:
+            return await fn()
+        except retry_on:
+            if n == attempts - 1:
+                raise
+            await asyncio.sleep(random.uniform(0, min(max_wait, 2 ** n)))
+    raise AssertionError("unreachable")
+
+
 def setup_logging(log_path: Path) -> None:
     fmt = "%(asctime)s [%(levelname)-8s] %(message)s"
     date_fmt = "%H:%M:%S"
@@ -110,35 +183,47 @@ class AlbumScraper:
         self.client = client
         self.sett = settings
 
+        # Constant for the scraper's lifetime, so merge once instead of per request
+        self._api_headers = {**settings.headers_api, 'Referer': album_url}
+        self._download_headers = {**settings.headers_download, 'Referer': album_url}
+
         self.url_log = self.dest / "scraped_urls.txt"
+        self.url_index = self.dest / "scraped_urls.idx"  # binary mirror of url_log
         self.failed_log = self.dest / "failed_downloads.txt"
+        self.hash_log = self.dest / "content_hashes.txt"
+
+        self._seen: set[str] = set()
+        # Checkpoint lines are buffered and written roughly every 10 batches
+        self._pending_checkpoint: list[str] = []
+        self._checkpoint_flush_threshold = 10 * settings.offset_step
+        # SHA-256 of every kept image → its filename, plus filenames dropped as duplicates
+        self._content_hashes: dict[bytes, str] = {}
+        self._duplicates: set[str] = set()
+        # Circuit breaker shared by all downloads
+        self._breaker_fails = 0
+        self._breaker_open_until = 0.0
 
     # ── Scraping Phase ─────────────────────────────────────────────── #
 
     async def fetch_batch(self, offset: int) -> list[str]:
         """Fetch one HTML chunk, extract image URLs from CSS-style background-image fields."""
         payload = {'al': 1, 'offset': offset, 'part': 1, 'rev': 1}
-        headers = {**self.sett.headers_api, 'Referer': self.album_url}
-
-        async for attempt in AsyncRetrying(
-            wait=wait_random_exponential(multiplier=1, max=20),
-            stop=stop_after_attempt(3),
-            retry=(
-                retry_if_exception_type(httpx.HTTPError)
-                | retry_if_exception_type(asyncio.TimeoutError)
-            ),
-            reraise=True,
-        ):
-            with attempt:
-                logging.debug("POST offset=%s (try %s)", offset, attempt.retry_state.attempt_number)
-                resp = await self.client.post(
-                    self.album_url, headers=headers, data=payload, timeout=30.0
-                )
-                resp.raise_for_status()
-
-        raw = resp.text.strip()
-        if raw.startswith('<!--') and raw.endswith('-->'):
-            raw = raw[4:-3].strip()
+        async def post() -> httpx.Response:
+            logging.debug("POST offset=%s", offset)
+            resp = await self.client.post(self.album_url, headers=self._api_headers, data=payload)
+            resp.raise_for_status()
+            return resp
+
+        resp = await retry_async(post, max_wait=20.0)
+
+        # Work on the raw body: no full-buffer UTF-8 decode, orjson takes bytes
+        if (resp.charset_encoding or 'utf-8').lower().replace('-', '') == 'utf8':
+            raw: bytes | memoryview = resp.content.strip()
+        else:
+            raw = resp.text.strip().encode()  # orjson only accepts UTF-8
+        if raw.startswith(COMMENT_PREFIX) and raw.endswith(COMMENT_SUFFIX):
+            # Zero-copy unwrap; orjson accepts memoryview and skips the inner whitespace
+            raw = memoryview(raw)[len(COMMENT_PREFIX):-len(COMMENT_SUFFIX)]
 
         try:
             data = orjson.loads(raw)
@@ -151,35 +236,56 @@ class AlbumScraper:
             (item for item in payload_data[1] if isinstance(item, str) and 'background-image' in item), ''
         ) if len(payload_data) > 1 else ''
 
-        urls = re.findall(r'url\((.*?)\)', html_blob)
+        urls = extract_urls(html_blob)
         cleaned = [
             u.replace('\\/', '/').removesuffix(self.sett.url_suffix_to_remove) for u in urls
         ]
         return cleaned
 
-    async def scrape_all_urls(self) -> list[str]:
-        offset = 0
+    async def scrape_all_urls(self, queue: DownloadQueue | None = None) -> list[str]:
+        """Scrape every photo URL; if *queue* is given, feed it each URL as found."""
         all_urls: list[str] = []
 
         # (Re)load checkpoint if present
         if self.url_log.exists():
-            async with aiofiles.open(self.url_log, 'r', encoding='utf-8') as f:
-                existing = await f.readlines()
-            all_urls.extend([u.strip() for u in existing])
+            all_urls.extend(await self._load_checkpoint())
+            self._seen.update(all_urls)
             logging.info("Loaded %d URLs from checkpoint.", len(all_urls))
+            await self._enqueue(queue, all_urls, 1)
+
+        try:
+            await self._scrape_loop(all_urls, queue)
+        finally:
+            await self._flush_checkpoint()
+            if all_urls and self.url_log.exists():
+                await self._write_index(all_urls)
+
+        # all_urls is already unique and in file-index order; no set/sort needed
+        logging.info("Scraping finished — %d unique URLs.", len(all_urls))
+        return all_urls
 
+    async def _scrape_loop(self, all_urls: list[str], queue: DownloadQueue | None) -> None:
+        offset = 0
+        loop = asyncio.get_running_loop()
+        delay_range = (self.sett.min_delay, self.sett.max_delay)
         while True:
+            # The politeness delay is measured start-to-start, so the time spent
+            # on the request itself (and on processing) counts towards it
+            not_before = loop.time() + (random.uniform(*delay_range) if delay_range[1] > 0 else 0)
             batch = await self.fetch_batch(offset)
             # Find only the URLs that are not already in our master list
-            new_urls = [u for u in batch if u and u not in all_urls]
+            new_urls = [u for u in batch if u and u not in self._seen]
 
             if not new_urls and offset > 0: # If no *new* URLs are found after the first page
                 logging.info("No more new photos found at offset %s. Scraping done.", offset)
                 break
 
             if new_urls:
+                self._seen.update(new_urls)
+                start = len(all_urls) + 1
                 all_urls.extend(new_urls)
                 await self._append_to_checkpoint(new_urls)
+                await self._enqueue(queue, new_urls, start)
                 logging.info(
                     "Offset %s: %d new URLs (total unique %d).",
                     offset, len(new_urls), len(all_urls),
@@ -190,59 +296,221 @@ class AlbumScraper:
                 break
 
             offset += self.sett.offset_step
-            await asyncio.sleep(random.uniform(self.sett.min_delay, self.sett.max_delay))
+            if (remaining := not_before - loop.time()) > 0:
+                await asyncio.sleep(remaining)
 
-        # Deduplicate once at the end for final list
-        unique = sorted(set(all_urls))
-        logging.info("Scraping finished — %d unique URLs.", len(unique))
-        return unique
+    @staticmethod
+    async def _enqueue(queue: DownloadQueue | None, urls: list[str], start: int) -> None:
+        if queue is None:
+            return
+        for i, u in enumerate(urls, start):
+            await queue.put((i, u))
 
     async def _append_to_checkpoint(self, urls: Iterable[str]) -> None:
-        async with aiofiles.open(self.url_log, 'a', encoding='utf-8') as f:
-            await f.writelines(u + '\n' for u in urls)
+        self._pending_checkpoint.extend(urls)
+        if len(self._pending_checkpoint) >= self._checkpoint_flush_threshold:
+            await self._flush_checkpoint()
+
+    async def _load_checkpoint(self) -> list[str]:
+        """Return checkpointed URLs in file order, from the index when it is current."""
+        size = self.url_log.stat().st_size
+        if self.url_index.exists():
+            try:
+                index = orjson.loads(await asyncio.to_thread(self.url_index.read_bytes))
+            except ValueError:
+                index = None
+            if isinstance(index, dict) and index.get('size') == size:
+                return index['urls']
+            logging.info("Checkpoint index is stale, reading %s.", self.url_log.name)
+
+        blob = await asyncio.to_thread(self.url_log.read_bytes)
+        # One decode + split (URLs contain no whitespace); dict keeps file order
+        return list(dict.fromkeys(blob.decode('utf-8').split()))
+
+    async def _write_index(self, urls: list[str]) -> None:
+        # Tagged with the text file's size so a stale index is detected on load
+        data = orjson.dumps({'size': self.url_log.stat().st_size, 'urls': urls})
+        await asyncio.to_thread(_sync_replace, self.url_index, data)
+
+    async def _flush_checkpoint(self) -> None:
+        if not self._pending_checkpoint:
+            return
+        data = ''.join(u + '\n' for u in self._pending_checkpoint).encode()
+        self._pending_checkpoint.clear()
+        await asyncio.to_thread(_sync_append, self.url_log, data)
 
     # ── Download Phase ─────────────────────────────────────────────── #
 
-    async def download_one(self, url: str, index: int, sem: asyncio.Semaphore) -> None:
+    async def download_one(self, url: str, index: int) -> None:
         file_ext = Path(url.split('?', 1)[0]).suffix or '.jpg'
         filename = f"{index:04d}{file_ext}"
         out_path = self.dest / filename
 
-        if out_path.exists():
+        if out_path.exists() or filename in self._duplicates:
             logging.debug("Skip existing %s", filename)
             return
 
-        async with sem:  # limit concurrency
-            headers = {**self.sett.headers_download, 'Referer': self.album_url}
+        try:
+            async def fetch() -> bytes | None:
+                # CDN URLs are normally served directly, so redirects are not
+                # followed by httpx; the rare 3xx chain is walked here instead
+                target = httpx.URL(url)
+                for _ in range(self.client.max_redirects + 1):
+                    async with self.client.stream(
+                        "GET", target, headers=self._download_headers
+                    ) as resp:
+                        if not resp.is_redirect:
+                            return await self._save_body(resp, out_path)
+                        target = resp.url.join(resp.headers['location'])
+                raise httpx.TooManyRedirects(
+                    f"Exceeded {self.client.max_redirects} redirects", request=resp.request
+                )
+
+            h = await retry_async(
+                lambda: self._through_breaker(fetch), max_wait=10.0, retry_on=(httpx.HTTPError,)
+            )
+        except Exception as e:
+            logging.warning("✘ %s (%s)", filename, e)
+            await asyncio.to_thread(_sync_append, self.failed_log, (url + '\n').encode())
+            return
+
+        if h is None:
+            return
+        original = self._content_hashes.setdefault(h, filename)
+        if original != filename:
+            out_path.unlink()
+            self._duplicates.add(filename)
+            logging.info("≡ %s is identical to %s, dropped", filename, original)
+        else:
+            logging.info("✔ %s", filename)
+        # Bookkeeping only: a failure here must not cost us the image itself
+        try:
+            await asyncio.to_thread(
+                _sync_append, self.hash_log, f"{h.hex()} {filename}\n".encode()
+            )
+        except OSError as e:
+            logging.warning("Could not record hash of %s (%s)", filename, e)
+
+    async def _save_body(self, resp: httpx.Response, out_path: Path) -> bytes | None:
+        """Write a streamed response to *out_path*; return the SHA-256 of the body.
+
+        Returns ``None`` without reading the body when Content-Length is outside
+        ``min_bytes``/``max_bytes``.
+        """
+        resp.raise_for_status()
+        size = int(resp.headers.get('content-length', 0))
+        if size and (size < self.sett.min_bytes or 0 < self.sett.max_bytes < size):
+            await resp.aclose()
+            logging.info("↷ %s skipped (%d bytes)", out_path.name, size)
+            return None
+        # Write to a .part file and rename only once complete, so an interrupted
+        # download never leaves a truncated image that a re-run would skip
+        part_path = out_path.with_name(out_path.name + '.part')
+        try:
+            # Small bodies fit in one chunk anyway: buffer them and do the
+            # whole open/write/close in a single thread hop
+            if 0 < size <= DOWNLOAD_CHUNK_SIZE:
+                body = await resp.aread()
+                await asyncio.to_thread(part_path.write_bytes, body)
+                part_path.replace(out_path)
+                return hashlib.sha256(body).digest()
+            # Stream to disk instead of buffering the whole image, hashing on the
+            # fly so the file never has to be re-read. Chunks are batched so each
+            # thread hop writes up to DOWNLOAD_FLUSH_SIZE bytes
+            digest = hashlib.sha256()
+            buf = bytearray()
+            f = await asyncio.to_thread(part_path.open, 'wb')
             try:
-                async for attempt in AsyncRetrying(
-                    wait=wait_random_exponential(multiplier=1, max=10),
-                    stop=stop_after_attempt(3),
-                    retry=retry_if_exception_type(httpx.HTTPError),
-                    reraise=True,
-                ):
-                    with attempt:
-                        resp = await self.client.get(
-                            url, headers=headers, timeout=30.0, follow_redirects=True
-                        )
-                        resp.raise_for_status()
-
-                async with aiofiles.open(out_path, 'wb') as f:
-                    await f.write(resp.content)
-                logging.info("✔ %s", filename)
-
-            except Exception as e:
-                logging.warning("✘ %s (%s)", filename, e)
-                async with aiofiles.open(self.failed_log, 'a', encoding='utf-8') as f:
-                    await f.write(url + '\n')
-
-    async def download_all(self, urls: list[str]) -> None:
-        sem = asyncio.Semaphore(self.sett.concurrent_downloads)
-        tasks = [
-            self.download_one(u, i, sem)
-            for i, u in enumerate(urls, 1)
-        ]
-        await asyncio.gather(*tasks, return_exceptions=False)
+                async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    buf += chunk
+                    if len(buf) >= DOWNLOAD_FLUSH_SIZE:
+                        await asyncio.to_thread(f.write, bytes(buf))
+                        buf.clear()
+                if buf:
+                    await asyncio.to_thread(f.write, bytes(buf))
+            finally:
+                await asyncio.to_thread(f.close)
+            part_path.replace(out_path)
+            return digest.digest()
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+
+    async def _through_breaker(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run *fn*, first waiting out an open breaker; trip it on repeated overload errors."""
+        if (wait := self._breaker_open_until - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+        try:
+            result = await fn()
+        except httpx.HTTPError as e:
+            if _is_overload(e):
+                self._breaker_fails += 1
+                if self._breaker_fails >= self.sett.breaker_threshold:
+                    self._breaker_fails = 0
+                    self._breaker_open_until = time.monotonic() + self.sett.breaker_cooldown
+                    logging.warning(
+                        "Server looks overloaded, pausing downloads for %.0fs.",
+                        self.sett.breaker_cooldown,
+                    )
+            raise
+        self._breaker_fails = 0
+        return result
+
+    async def _load_content_hashes(self) -> None:
+        if not self.hash_log.exists():
+            return
+        blob = await asyncio.to_thread(self.hash_log.read_bytes)
+        for line in blob.decode('utf-8').splitlines():
+            hex_digest, _, filename = line.partition(' ')
+            if not filename:
+                continue
+            original = self._content_hashes.setdefault(bytes.fromhex(hex_digest), filename)
+            if original != filename:
+                self._duplicates.add(filename)
+        logging.info("Loaded %d content hashes.", len(self._content_hashes))
+
+    async def _download_worker(self, queue: DownloadQueue) -> None:
+        while (item := await queue.get()) is not None:
+            index, url = item
+            try:
+                await self.download_one(url, index)
+            except Exception:
+                # e.g. the failed-log append itself failing; keep draining the queue
+                logging.exception("Unexpected error while downloading %s", url)
+
+    async def _produce(self, queue: DownloadQueue, n_workers: int) -> int:
+        urls = await self.scrape_all_urls(queue)
+        for _ in range(n_workers):  # one sentinel per worker
+            await queue.put(None)
+        return len(urls)
+
+    async def run(self) -> int:
+        """Scrape and download concurrently; returns the number of unique URLs.
+
+        The scraper feeds a bounded queue drained by ``concurrent_downloads``
+        workers, so downloads start with the first batch.
+        """
+        await self._load_content_hashes()
+        queue: DownloadQueue = asyncio.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+        n_workers = self.sett.concurrent_downloads
+        workers = [asyncio.create_task(self._download_worker(queue)) for _ in range(n_workers)]
+        producer = asyncio.create_task(self._produce(queue, n_workers))
+        tasks = [producer, *workers]
+        try:
+            # A task dying early (scraper or worker) must not leave the others
+            # blocked on the queue, so wake up on the first failure
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for t in done:
+                t.result()  # re-raise the first failure, if any
+        except BaseException:
+            # Cancel and wait for the rest so their .part files are cleaned up
+            # before the caller closes the HTTP client
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return producer.result()
 
 
 # ──────────────────────────────── CLI / MAIN ─────────────────────────── #
@@ -275,21 +543,28 @@ async def async_main() -> None:
     logging.info("Normalized Album URL: %s", album_url)
     logging.info("Destination folder: %s", dest_dir)
 
-    async with httpx.AsyncClient(http2=True) as client:
+    # Size the pool from the worker count so retries/redirects never queue on it
+    limits = httpx.Limits(
+        max_connections=max(32, SETTINGS.concurrent_downloads * 4),
+        max_keepalive_connections=SETTINGS.concurrent_downloads * 2,
+        keepalive_expiry=30.0,
+    )
+    timeout = httpx.Timeout(connect=10.0, read=30.0, write=10.0, pool=5.0)
+
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
         # The scraper no longer needs to create the directory itself.
         scraper = AlbumScraper(album_url, dest_dir, client)
-        urls = await scraper.scrape_all_urls()
-        if not urls:
+        if not await scraper.run():
             logging.info("No URLs scraped — nothing to download.")
             return
-        await scraper.download_all(urls)
 
     logging.info("👍  All done — images saved in %s", dest_dir)
 
 
 def main() -> None:  # Sync wrapper because Windows + asyncio.run quirks
     try:
-        asyncio.run(async_main())
+        run = uvloop.run if uvloop is not None else asyncio.run
+        run(async_main())
     except KeyboardInterrupt:
         print("\nInterrupted by user.")
 